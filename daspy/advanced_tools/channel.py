@@ -3,9 +3,38 @@
 # Date: 2024.4.22
 # Email: hmz2018@mail.ustc.edu.cn
 import numpy as np
-from copy import deepcopy
-from geographiclib.geodesic import Geodesic
-from pyproj import Proj
+from functools import lru_cache
+from numba import njit, prange
+from pyproj import Geod, Proj
+from scipy.spatial import cKDTree
+
+
+_WGS84 = Geod(ellps='WGS84')
+
+
+def _median(x):
+    # quickselect median of a 1-D array, same result as np.median
+    n = len(x)
+    if np.isnan(x).any():
+        return np.nan
+    k = n // 2
+    if n % 2:
+        return np.partition(x, k)[k]
+    part = np.partition(x, (k - 1, k))
+    return (part[k - 1] + part[k]) / 2
+
+
+def _mad(x):
+    median = _median(x)
+    return median, _median(abs(x - median))
+
+
+def _scaled_lstsq(V, data, rcond):
+    # same column scaling as numpy.polyfit to keep the system well conditioned
+    scale = np.sqrt((V * V).sum(axis=0))
+    scale[scale == 0] = 1
+    coef = np.linalg.lstsq(V / scale, data, rcond=rcond)[0]
+    return coef / scale
 
 
 def robust_polyfit(data, deg, thresh):
@@ -18,36 +47,50 @@ def robust_polyfit(data, deg, thresh):
     :return: Fitting data
     """
     nch = len(data)
-    channels = np.arange(nch)
-    p_coef = np.polyfit(channels, data, deg)
-    p_fit = np.poly1d(p_coef)
-    old_data = p_fit(channels)
+    V = np.vander(np.arange(nch, dtype=float), deg + 1)
+    rcond = nch * np.finfo(float).eps
+    old_data = V @ _scaled_lstsq(V, data, rcond)
     mse = 1
 
     # robust fitting until the fitting curve changes < 0.1% at every point.
     while mse > 0.001:
         rsl = abs(data - old_data)
-        mad = np.median(rsl)
-        weights = np.zeros(nch)
-        weights[rsl < thresh * mad] = 1
-        p_coef = np.polyfit(channels, data, deg, w=weights)
-        p_fit = np.poly1d(p_coef)
-        new_data = p_fit(channels)
+        mad = _median(rsl)
+        inlier = rsl < thresh * mad
+        # 0/1 weights, so only the inlier rows enter the least squares
+        new_data = V @ _scaled_lstsq(V[inlier], data[inlier], rcond)
         mse = np.nanmax(np.abs((new_data - old_data) / old_data))
         old_data = new_data
 
+    weights = inlier.astype(float)
     return new_data, weights
 
 
+@njit(cache=True)
+def _continuity_checking_numba(lst1, in_lst2, adjacent, toleration):
+    n = len(in_lst2)
+    move = np.zeros(len(lst1), dtype=np.bool_)
+    for i in range(len(lst1)):
+        chn = lst1[i]
+        discont = 0
+        for a in range(max(chn - adjacent, 0), min(chn + adjacent + 1, n)):
+            discont += in_lst2[a]
+        if discont >= adjacent * 2 + 1 - toleration:
+            # channels moved earlier count for the following ones
+            in_lst2[chn] = True
+            move[i] = True
+    return move
+
+
 def _continuity_checking(lst1, lst2, adjacent=2, toleration=2):
-    lst1_raw = deepcopy(lst1)
-    for chn in lst1_raw:
-        discont = [a for a in lst2 if abs(a - chn) <= adjacent]
-        if len(discont) >= adjacent * 2 + 1 - toleration:
-            lst1.remove(chn)
-            lst2.append(chn)
+    lst1 = np.asarray(lst1, dtype=int)
+    lst2 = np.asarray(lst2, dtype=int)
+    in_lst2 = np.zeros(max(lst1.max(initial=-1), lst2.max(initial=-1)) + 1,
+                       dtype=bool)
+    in_lst2[lst2] = True
+    move = _continuity_checking_numba(lst1, in_lst2, adjacent, toleration)
 
-    return lst1, lst2
+    return lst1[~move], np.concatenate((lst2, lst1[move]))
 
 
 def channel_checking(data, deg=10, thresh=5, continuity=True, adjacent=2,
@@ -70,7 +113,6 @@ def channel_checking(data, deg=10, thresh=5, continuity=True, adjacent=2,
         likely to have low or high amplitude.
     :return: Good channels and bad channels.
     """
-    nch = len(data)
     energy = np.log10(np.sum(data**2, axis=1))
 
     # Remove abnormal value by robust polynomial fitting.
@@ -78,15 +120,15 @@ def channel_checking(data, deg=10, thresh=5, continuity=True, adjacent=2,
     deviation = energy - fitted_energy
 
     # Iterate eliminates outliers.
-    mad = np.median(abs(deviation[weights > 0]))
+    mad = _median(abs(deviation[weights > 0]))
     if mode == 'low':
-        bad_chn = np.argwhere(deviation < -thresh * mad).ravel().tolist()
-    elif mode == 'high':
-        bad_chn = np.argwhere(deviation > thresh * mad).ravel().tolist()
+        bad = deviation < -thresh * mad
     elif mode == 'high':
-        bad_chn = np.argwhere(deviation < -thresh * mad).ravel().tolist() + \
-                np.argwhere(deviation > thresh * mad).ravel().tolist()
-    good_chn = list(set(range(nch)) - set(bad_chn))
+        bad = deviation > thresh * mad
+    elif mode == 'both':
+        bad = abs(deviation) > thresh * mad
+    good_chn = np.flatnonzero(~bad)
+    bad_chn = np.flatnonzero(bad)
 
     if continuity:
         # Discontinuous normal value are part of bad channels.
@@ -99,33 +141,29 @@ def channel_checking(data, deg=10, thresh=5, continuity=True, adjacent=2,
                                                  adjacent=adjacent,
                                                  toleration=toleration)
 
-    bad_chn = np.sort(np.array(bad_chn))
-    good_chn = np.sort(np.array(good_chn))
+        bad_chn = np.sort(bad_chn)
+        good_chn = np.sort(good_chn)
+
     if verbose:
         return good_chn, bad_chn, energy, fitted_energy - thresh * mad
 
     return good_chn, bad_chn
 
 
-def _channel_location(tx, ty, tn):
-    l_track = np.sqrt(np.diff(tx) ** 2 + np.diff(ty) ** 2)
-    l_track_cum = np.hstack(([0], np.cumsum(l_track)))
-    idx_kp = np.where(tn >= 0)[0]
-
-    interp_ch = []
-    chn = np.floor(tn[idx_kp[0]])
+@njit(cache=True)
+def _channel_location_numba(tx, ty, tn, l_track, idx_kp, d_interp, chn,
+                            interp_ch):
+    w = 0
     if abs(chn - tn[idx_kp[0]]) < 1e-6:
-        interp_ch.append([tx[idx_kp[0]], ty[idx_kp[0]], chn])
+        interp_ch[w, 0] = tx[idx_kp[0]]
+        interp_ch[w, 1] = ty[idx_kp[0]]
+        interp_ch[w, 2] = chn
+        w += 1
 
-    seg_interval = []
     for i in range(1, len(idx_kp)):
-        # calculate actual interval between known-channel points
         istart, iend = idx_kp[i - 1], idx_kp[i]
-        n_chn_kp = tn[iend] - tn[istart]
-        d_interp = (l_track_cum[iend] - l_track_cum[istart]) / n_chn_kp
-        seg_interval.append([tn[istart], tn[iend], d_interp])
-
-        l_res = 0  # remaining fiber length before counting the next segment
+        d = d_interp[i - 1]
+        l_res = 0.  # remaining fiber length before counting the next segment
         # consider if the given channelnumber is not an integer
         chn_res = tn[istart] - int(tn[istart])
         for j in range(istart, iend):
@@ -133,40 +171,72 @@ def _channel_location(tx, ty, tn):
 
             # if tp segment length is large for more than one interval, get the
             # channel loc
-            if l_start >= d_interp * (1 - chn_res):
+            if l_start >= d * (1 - chn_res):
                 # floor int, num of channel available
-                n_chn_tp = int(l_start / d_interp + chn_res)
-                l_new = (np.arange(n_chn_tp) + 1 - chn_res) * d_interp - \
-                    l_res  # channel distance from segment start
-
-                # interpolate the channel loc
-                tx_new = np.interp(l_new, [0, l_track[j]], [tx[j], tx[j + 1]])
-                ty_new = np.interp(l_new, [0, l_track[j]], [ty[j], ty[j + 1]])
-                # fx = interp1d([0, l_track[j + 1]], [tx[j], tx[j + 1]])
-                # fy = interp1d([0, l_track[j + 1]], [ty[j], ty[j + 1]])
-                # tx_new, ty_new = fx(l_new), fy(x_new)
+                n_chn_tp = int(l_start / d + chn_res)
+                for k in range(n_chn_tp):
+                    # channel distance from segment start
+                    l_new = (k + 1 - chn_res) * d - l_res
+                    # linearly interpolate the channel loc
+                    if l_track[j] > 0:
+                        frac = min(max(l_new / l_track[j], 0.), 1.)
+                    else:
+                        frac = 1.
+                    chn += 1
+                    interp_ch[w, 0] = tx[j] + frac * (tx[j + 1] - tx[j])
+                    interp_ch[w, 1] = ty[j] + frac * (ty[j + 1] - ty[j])
+                    interp_ch[w, 2] = chn
+                    w += 1
 
                 # remaining length to add to next segment
-                l_res = l_start - n_chn_tp * d_interp
-
-                # write interpolated channel loc
-                for (xi, yi) in zip(tx_new, ty_new):
-                    chn += 1
-                    interp_ch.append([xi, yi, chn])
+                l_res = l_start - n_chn_tp * d
 
                 # handle floor int problem when l_start/d_interp is near an
                 # interger
-                if (d_interp - l_res) / d_interp < 1e-6:
+                if (d - l_res) / d < 1e-6:
                     chn += 1
-                    interp_ch.append([tx[j + 1], ty[j + 1], int(tn[j + 1])])
-                    l_res = 0
-                chn_res = 0
+                    interp_ch[w, 0] = tx[j + 1]
+                    interp_ch[w, 1] = ty[j + 1]
+                    interp_ch[w, 2] = int(tn[j + 1])
+                    w += 1
+                    l_res = 0.
+                chn_res = 0.
             # if tp segment length is not enough for one interval, simply add
             # the length to next segment
-            elif l_start < d_interp:
+            elif l_start < d:
                 l_res = l_start
 
-    return np.array(seg_interval), np.array(interp_ch)
+    return w
+
+
+def _channel_location(tx, ty, tn):
+    tx, ty, tn = (np.asarray(v, dtype=float) for v in (tx, ty, tn))
+    l_track = np.sqrt(np.diff(tx) ** 2 + np.diff(ty) ** 2)
+    l_track_cum = np.empty(len(l_track) + 1)
+    l_track_cum[0] = 0
+    np.cumsum(l_track, out=l_track_cum[1:])
+    idx_kp = np.where(tn >= 0)[0]
+
+    # calculate actual interval between known-channel points
+    istart, iend = idx_kp[:-1], idx_kp[1:]
+    d_interp = (l_track_cum[iend] - l_track_cum[istart]) / \
+        (tn[iend] - tn[istart])
+    seg_interval = np.column_stack((tn[istart], tn[iend], d_interp))
+
+    # conservative upper bound of the number of interpolated channels
+    n_max = int(np.sum(abs(np.diff(tn[idx_kp])))) + 2 * len(idx_kp) + \
+        len(tx) + 1
+    interp_ch = np.empty((n_max, 3))
+    chn = np.floor(tn[idx_kp[0]])
+    w = _channel_location_numba(tx, ty, tn, l_track, idx_kp, d_interp, chn,
+                                interp_ch)
+
+    return seg_interval, interp_ch[:w]
+
+
+@lru_cache(maxsize=64)
+def _utm_proj(zone):
+    return Proj(proj='utm', zone=zone, ellps='WGS84', preserve_units=False)
 
 
 def location_interpolation(known_pt, track_pt=None, dx=None, data_type='lonlat',
@@ -179,7 +249,8 @@ def location_interpolation(known_pt, track_pt=None, dx=None, data_type='lonlat',
     :param track_pt: M*2 np.ndarray. Optional fiber spatial track points without
         channel numbers. Each row includes two coordinates.
     :param dx: Known points far from the track (> dx) will be excluded.
-        Recommended setting is channel interval. The unit is m.
+        Recommended setting is channel interval. The unit is m. None means no
+        known point will be excluded.
     :param data_type: str. Coordinate type. 'lonlat' for longitude and latitude,
         'xy' for x and y.
     :param verbose: bool. If True, return interpoleted channel location and
@@ -189,42 +260,42 @@ def location_interpolation(known_pt, track_pt=None, dx=None, data_type='lonlat',
     if data_type == 'lonlat':
         klo, kla, kn = known_pt.T
         zone = np.floor((max(klo) + min(klo)) / 2 / 6).astype(int) + 31
-        DASProj = Proj(proj='utm', zone=zone, ellps='WGS84',
-                       preserve_units=False)
-        kx, ky = DASProj(klo, kla)
+        DASProj = _utm_proj(int(zone))
+        if track_pt is None:
+            kx, ky = DASProj(klo, kla)
+        else:
+            # project known points and track points in one call
+            tlo, tla = track_pt.T
+            x, y = DASProj(np.hstack((klo, tlo)), np.hstack((kla, tla)))
+            kx, tx = x[:len(klo)], x[len(klo):]
+            ky, ty = y[:len(klo)], y[len(klo):]
     elif data_type == 'xy':
         kx, ky, kn = known_pt.T
+        if track_pt is not None:
+            tx, ty = track_pt.T
 
     if track_pt is None:
         seg_interval, interp_ch = _channel_location(kx, ky, kn)
     else:
-        if data_type == 'lonlat':
-            tlo, tla = track_pt.T
-            tx, ty = DASProj(tlo, tla)
-        elif data_type == 'xy':
-            tx, ty = track_pt.T
-
         tn = np.zeros(len(track_pt)) - 1
 
         # insert the known points into the fiber track data
-        K = len(klo)
-        dx_matrix = np.tile(tx, (len(kx), 1)) - np.tile(kx, (len(tx), 1)).T
-        dy_matrix = np.tile(ty, (len(ky), 1)) - np.tile(ky, (len(ty), 1)).T
-        d = np.sqrt(dx_matrix ** 2 + dy_matrix ** 2)
-        idx = np.argmin(d, axis=1)
-        for i in range(K):
-            if d[i, idx[i]] < dx:
-                tn[idx[i]] = kn[i]
-                last_pt = idx[i]
-
-        # interpolation with regular spacing along the fiber track
-        try:
-            tx, ty, tn = tx[:last_pt + 1], ty[:last_pt + 1], tn[:last_pt + 1]
-        except NameError:
+        if dx is None:
+            dx = np.inf
+        tree = cKDTree(np.column_stack([tx, ty]))
+        d, idx = tree.query(np.column_stack([kx, ky]), k=1,
+                            distance_upper_bound=dx)
+        valid = d < dx
+        if not valid.any():
             print('All known points are too far away from the track points.' +
                   'If they are reliable, they can be merged in sequence as' +
                   'track points to input')
             return None
+        tn[idx[valid]] = kn[valid]
+        last_pt = idx[valid][-1]
+
+        # interpolation with regular spacing along the fiber track
+        tx, ty, tn = tx[:last_pt + 1], ty[:last_pt + 1], tn[:last_pt + 1]
         seg_interval, interp_ch = _channel_location(tx, ty, tn)
 
     if data_type == 'lonlat':
@@ -236,29 +307,52 @@ def location_interpolation(known_pt, track_pt=None, dx=None, data_type='lonlat',
     return interp_ch
 
 
+@njit(cache=True, fastmath={'reassoc', 'contract'}, error_model='numpy')
 def _xcorr(x, y):
+    # single pass over both series; shifting by the first sample keeps the
+    # sums small and avoids cancellation for data with large offsets
     N = len(x)
-    meanx = np.mean(x)
-    meany = np.mean(y)
-    stdx = np.std(np.asarray(x))
-    stdy = np.std(np.asarray(y))
-    c = np.sum((y - meany) * (x - meanx)) / (N * stdx * stdy)
-    return c
+    x0, y0 = x[0], y[0]
+    sx = sy = sxx = syy = sxy = 0.
+    for i in range(N):
+        dx = x[i] - x0
+        dy = y[i] - y0
+        sx += dx
+        sy += dy
+        sxx += dx * dx
+        syy += dy * dy
+        sxy += dx * dy
+    return (N * sxy - sx * sy) / np.sqrt((N * sxx - sx * sx) *
+                                         (N * syy - sy * sy))
+
+
+@njit(cache=True, parallel=True)
+def _xcorr_adjacent(data):
+    nch = len(data)
+    cc = np.zeros(nch - 1)
+    for i in prange(nch - 1):
+        cc[i] = _xcorr(data[i], data[i + 1])
+    return cc
+
+
+def _geodesic_inverse_shifted(lon, lat, gap):
+    nch = len(lon)
+    idx = np.arange(1, nch - 1)
+    idx_s = np.maximum(idx - gap, 0)
+    idx_e = np.minimum(idx + gap, nch - 1)
+    azi_s, _, s12_s = _WGS84.inv(lon[idx_s], lat[idx_s], lon[idx], lat[idx])
+    azi_e, _, s12_e = _WGS84.inv(lon[idx], lat[idx], lon[idx_e], lat[idx_e])
+    return idx, idx_s, idx_e, azi_s, azi_e, s12_s, s12_e
 
 
 def _horizontal_angle_change(geo, gap=10):
     nch = len(geo)
     angle = np.zeros(nch)
-    for i in range(1, nch - 1):
-        lon, lat = geo[i]
-        lon_s, lat_s = geo[max(i - gap, 0)]
-        lon_e, lat_e = geo[min(i + gap, nch - 1)]
-        azi_s = Geodesic.WGS84.Inverse(lat_s, lon_s, lat, lon)['azi1']
-        azi_e = Geodesic.WGS84.Inverse(lat, lon, lat_e, lon_e)['azi1']
-        dazi = azi_e - azi_s
-        if abs(dazi) > 180:
-            dazi = -np.sign(dazi) * (360 - abs(dazi))
-        angle[i] = dazi
+    idx, _, _, azi_s, azi_e, _, _ = _geodesic_inverse_shifted(
+        geo[:, 0], geo[:, 1], gap)
+    dazi = azi_e - azi_s
+    dazi = np.where(abs(dazi) > 180, -np.sign(dazi) * (360 - abs(dazi)), dazi)
+    angle[idx] = dazi
 
     return angle
 
@@ -266,33 +360,40 @@ def _horizontal_angle_change(geo, gap=10):
 def _vertical_angle_change(geo, gap=10):
     nch = len(geo)
     angle = np.zeros(nch)
-    for i in range(1, nch - 1):
-        lon, lat, dep = geo[i]
-        lon_s, lat_s, dep_s = geo[max(i - gap, 0)]
-        lon_e, lat_e, dep_e = geo[min(i + gap, nch - 1)]
-        s12_s = Geodesic.WGS84.Inverse(lat_s, lon_s, lat, lon)['s12']
-        theta_s = np.arctan((dep - dep_s) / s12_s) / np.pi * 180
-        s12_e = Geodesic.WGS84.Inverse(lat, lon, lat_e, lon_e)['s12']
-        theta_e = np.arctan((dep_e - dep) / s12_e) / np.pi * 180
-        angle[i] = theta_e - theta_s
+    lon, lat, dep = geo[:, 0], geo[:, 1], geo[:, 2]
+    idx, idx_s, idx_e, _, _, s12_s, s12_e = _geodesic_inverse_shifted(lon, lat,
+                                                                     gap)
+    theta_s = np.arctan((dep[idx] - dep[idx_s]) / s12_s) / np.pi * 180
+    theta_e = np.arctan((dep[idx_e] - dep[idx]) / s12_e) / np.pi * 180
+    angle[idx] = theta_e - theta_s
 
     return angle
 
 
+@njit(cache=True)
+def _local_maximum_indexes_numba(data, thresh):
+    n = len(data)
+    max_idx = np.empty(n, dtype=np.int64)
+    w = 0
+    i = 0
+    while i < n:
+        if data[i] > thresh:
+            # index of the maximum in this run of values above thresh
+            imax = i
+            while i < n and data[i] > thresh:
+                if data[i] > data[imax]:
+                    imax = i
+                i += 1
+            max_idx[w] = imax
+            w += 1
+        else:
+            i += 1
+    return max_idx[:w]
+
+
 def _local_maximum_indexes(data, thresh):
-    idx = np.where(data > thresh)[0]
-    if len(idx):
-        i = list(np.where(np.diff(idx) > 1)[0] + 1)
-        if len(idx) - 1 not in i:
-            i.append(len(idx) - 1)
-        b = 0
-        max_idx = []
-        for e in i:
-            max_idx.append(idx[b] + np.argmax(data[idx[b]:idx[e]]))
-            b = e
-        return max_idx
-    else:
-        return []
+    return _local_maximum_indexes_numba(np.asarray(data, dtype=float),
+                                        float(thresh)).tolist()
 
 
 def turning_points(data, data_type='coordinate', thresh=5, depth_info=False,
@@ -330,14 +431,10 @@ def turning_points(data, data_type='coordinate', thresh=5, depth_info=False,
         return turning_h
 
     elif data_type == 'waveform':
-        nch = len(data)
-        cc = np.zeros(nch - 1)
-        for i in range(nch - 1):
-            cc[i] = _xcorr(data[i], data[i + 1])
-        median = np.median(cc)
-        mad = np.median(abs(cc - median))
-
-        return np.argwhere(cc < median - thresh * mad)[0]
+        cc = _xcorr_adjacent(np.asarray(data, dtype=float))
+        median, mad = _mad(cc)
+
+        return np.flatnonzero(cc < median - thresh * mad)
 
     else:
         raise ValueError('Data_type should be \'coordinate\' or \'waveform\'.')
@@ -3,12 +3,38 @@
 # Date: 2024.4.11
 # Email: hmz2018@mail.ustc.edu.cn
 import numpy as np
-from numpy.fft import irfft2, ifftshift
+from scipy.fft import irfft2, ifftshift
 from daspy.basic_tools.preprocessing import padding, cosine_taper
 from daspy.basic_tools.freqattributes import next_pow_2, fk_transform
 from daspy.advanced_tools.denoising import curvelet_denoising
 
 
+def _cosine_edge(dist, width):
+    if width <= 0:
+        return (dist > 0).astype(float)
+    return 0.5 - 0.5 * np.cos(np.clip(dist / width, 0, 1) * np.pi)
+
+
+def _fan_taper(p, pmin, pmax, edge):
+    p = abs(p)
+    taper = np.ones(p.shape)
+    if pmin:
+        if isinstance(pmin, (tuple, list, np.ndarray)):
+            tp_b, tp_e = min(pmin), max(pmin)
+        else:
+            tp_b, tp_e = pmin * max(1 - edge / 2, 0), pmin * (1 + edge / 2)
+        taper *= _cosine_edge(p - tp_b, tp_e - tp_b)
+
+    if pmax:
+        if isinstance(pmax, (tuple, list, np.ndarray)):
+            tp_b, tp_e = max(pmax), min(pmax)
+        else:
+            tp_b, tp_e = pmax * (1 + edge / 2), pmax * (1 - edge / 2)
+        taper *= _cosine_edge(tp_b - p, tp_b - tp_e)
+
+    return taper
+
+
 def fk_fan_mask(f, k, fmin=None, fmax=None, kmin=None, kmax=None, vmin=None,
                 vmax=None, edge=0.1, flag=None):
     """
@@ -24,35 +50,16 @@ def fk_fan_mask(f, k, fmin=None, fmax=None, kmin=None, kmax=None, vmin=None,
         velocities.
     :return: Fan mask.
     """
-    ff = np.tile(f, (len(k), 1))
-    kk = np.tile(k, (len(f), 1)).T
-    vv = - np.divide(ff, kk, out=np.ones_like(ff) * 1e10, where=kk != 0)
+    ff = f[np.newaxis, :]
+    kk = k[:, np.newaxis]
+    vv = - np.divide(ff, kk, out=np.full((len(k), len(f)), 1e10),
+                     where=kk != 0)
     mask = np.ones(vv.shape)
-    for phy_quan in ['f', 'k', 'v']:
-        p = eval(phy_quan * 2)
-        pmin = eval(phy_quan + 'min')
-        if pmin:
-            if isinstance(pmin, (tuple, list, np.ndarray)):
-                tp_b, tp_e = min(pmin), max(pmin)
-            else:
-                tp_b, tp_e = pmin * max(1 - edge / 2, 0), pmin * (1 + edge / 2)
-            tp_wid = tp_e - tp_b
-            mask[(abs(p) <= tp_b)] = 0
-            area = (abs(p) > tp_b) & (abs(p) < tp_e)
-            mask[area] *= 0.5 - 0.5 * \
-                np.cos(((abs(p[area]) - tp_b) / tp_wid) * np.pi)
-
-        pmax = eval(phy_quan + 'max')
-        if pmax:
-            if isinstance(pmax, (tuple, list, np.ndarray)):
-                tp_b, tp_e = max(pmax), min(pmax)
-            else:
-                tp_b, tp_e = pmax * (1 + edge / 2), pmax * (1 - edge / 2)
-            tp_wid = tp_b - tp_e
-            mask[(abs(p) >= tp_b)] = 0
-            area = (abs(p) > tp_e) & (abs(p) < tp_b)
-            mask[area] *= 0.5 - 0.5 * \
-                np.cos(((tp_b - abs(p[area])) / tp_wid) * np.pi)
+    params = {'f': (ff, fmin, fmax), 'k': (kk, kmin, kmax),
+              'v': (vv, vmin, vmax)}
+    for p, pmin, pmax in params.values():
+        if pmin or pmax:
+            mask *= _fan_taper(p, pmin, pmax, edge)
 
     if flag:
         mask[np.sign(vv) == flag] = 0
@@ -66,7 +73,8 @@ def fk_filter(data, dx, fs, taper=(0.02, 0.05), pad='default', fmin=None,
     Transform the data to the f-k domain using 2-D Fourier transform method, and
     transform back to the x-t domain after filtering.
 
-    :param data: numpy.ndarray. Data to do fk filter.
+    :param data: numpy.ndarray. Data to do fk filter. float32 is recommended,
+        it is kept in single precision through the whole filter.
     :param dx: Channel interval in m.
     :param fs: Sampling rate in Hz.
     :param taper: float or sequence of floats. Each float means decimal
@@ -91,6 +99,10 @@ def fk_filter(data, dx, fs, taper=(0.02, 0.05), pad='default', fmin=None,
     """
     if izero:
         zeropat = data == 0
+        # keep only the indexes when zeros are sparse to reduce memory during
+        # the FFT (index pairs cost 16 bytes per zero)
+        if np.count_nonzero(zeropat) < 0.05 * zeropat.size:
+            zeropat = np.nonzero(zeropat)
 
     data_tp = cosine_taper(data, taper)
     if pad == 'default':
@@ -112,7 +124,13 @@ def fk_filter(data, dx, fs, taper=(0.02, 0.05), pad='default', fmin=None,
     mask = fk_fan_mask(f, k, fmin, fmax, kmin, kmax, vmin, vmax, edge=edge,
                        flag=flag)
 
-    data_flt = irfft2(ifftshift(fk * mask, axes=0)).real[:nch, :nt]
+    if nfft is None:
+        nfft = (nch, nt)
+    else:
+        nfft = (next_pow_2(nch), next_pow_2(nt))
+    data_flt = irfft2(ifftshift(fk * mask.astype(fk.real.dtype, copy=False),
+                                axes=0), s=nfft, workers=-1,
+                      overwrite_x=True)[:nch, :nt]
     data_flt = padding(data_flt, dn, reverse=True)
 
     if izero:
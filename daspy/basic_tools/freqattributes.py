@@ -3,7 +3,7 @@
 # Date: 2024.4.1
 # Email: hmz2018@mail.ustc.edu.cn
 import numpy as np
-from numpy.fft import rfft, rfft2, fftshift, fftfreq, rfftfreq
+from scipy.fft import rfft, rfft2, fftshift, fftfreq, rfftfreq
 from scipy.signal import stft
 from daspy.basic_tools.preprocessing import demeaning, detrending, cosine_taper
 
@@ -94,7 +94,8 @@ def fk_transform(data, dx, fs, taper=(0, 0.05), nfft='default'):
     """
     Transform the data to the fk domain using 2-D Fourier transform method.
 
-    :param data: numpy.ndarray. Data to do fk transform.
+    :param data: numpy.ndarray. Data to do fk transform. float32 data give a
+        complex64 spectrum, which halves memory and FFT cost.
     :param dx: Channel interval in m.
     :param fs: Sampling rate in Hz.
     :param taper: float or sequence of floats. Each float means decimal
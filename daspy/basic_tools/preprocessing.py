@@ -3,6 +3,8 @@
 # Date: 2024.4.11
 # Email: hmz2018@mail.ustc.edu.cn
 import numpy as np
+from functools import lru_cache
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.signal import detrend
 from scipy.signal.windows import tukey
 from daspy.basic_tools.filter import lowpass_cheby_2
@@ -36,15 +38,14 @@ def normalization(data, method='z-score'):
         data = data.reshape(1, len(data))
     elif len(data.shape) != 2:
         raise ValueError("Data should be 1-D or 2-D array")
-    nt = len(data[0])
     if method == 'max':
-        amp = np.tile(np.max(abs(data), 1), (nt, 1)).T
+        amp = np.max(abs(data), axis=1, keepdims=True)
         amp[amp == 0] = amp[amp > 0].min()
         return data / amp
 
     if method == 'z-score':
-        mean = np.tile(np.mean(data, axis=1), (nt, 1)).T
-        std = np.tile(np.std(data, axis=1), (nt, 1)).T
+        mean = np.mean(data, axis=1, keepdims=True)
+        std = np.std(data, axis=1, keepdims=True)
         std[std == 0] = std[std > 0].min()
         return (data - mean) / std
 
@@ -81,36 +82,49 @@ def stacking(data, N, step=None):
     if step is None:
         step = N
     nch, nt = data.shape
-    begin = np.arange(0, nch - N + 1, step)
-    end = begin + N
-    nx1 = len(begin)
-    data_stacked = np.zeros((nx1, nt))
-    for i in range(nx1):
-        data_stacked[i, :] = np.mean(data[begin[i]:end[i], :], axis=0)
-    return data_stacked
+    if step == N or nch < N:
+        # nx1 is 0 if N is larger than nch, which gives an empty result
+        nx1 = nch // N
+        return data[:nx1 * N].reshape(nx1, N, nt).mean(axis=1)
+
+    return sliding_window_view(data, N, axis=0)[::step].mean(axis=-1)
+
+
+def _window_dtype(data):
+    # keep single precision data in single precision, otherwise use double
+    if data.dtype in (np.float32, np.complex64):
+        return np.float32
+    return np.float64
+
+
+@lru_cache(maxsize=32)
+def _tukey(n, p, dtype=np.float64):
+    win = tukey(n, p).astype(dtype)
+    win.flags.writeable = False
+    return win
 
 
 def cosine_taper(data, p=0.1):
     """
     Taper using Tukey window.
 
-    :param data: numpy.ndarray. Data to taper.
+    :param data: numpy.ndarray. Data to taper. float32 data are tapered in
+        single precision.
     :param p: float or sequence of floats. Each float means decimal percentage
         of Tukey taper for corresponding dimension (ranging from 0 to 1).
         Default is 0.1 which tapers 5% from the beginning and 5% from the end.
         If only one float is given, it only do for time dimension.
     :return: Tapered data.
     """
+    dtype = _window_dtype(data)
     if len(data.shape) == 1:
-        return data * tukey(len(data), p)
+        return data * _tukey(len(data), p, dtype)
     nch, nt = data.shape
-    win = np.ones_like(data)
     if not isinstance(p, (tuple, list, np.ndarray)):
         p = (0, p)
 
-    win *= np.tile(tukey(nch, p[0]), (nt, 1)).T
-    win *= np.tile(tukey(nt, p[1]), (nch, 1))
-    return data * win
+    return data * _tukey(nch, p[0], dtype)[:, np.newaxis] * \
+        _tukey(nt, p[1], dtype)
 
 
 def downsampling(data, xint=None, tint=None, stack=True, filter=True):
@@ -124,7 +138,7 @@ def downsampling(data, xint=None, tint=None, stack=True, filter=True):
     :param filter: bool. Filter before time downsampling or not.
     :return: Downsampled data.
     """
-    data_ds = data.copy()
+    data_ds = data
     if xint:
         if stack:
             data_ds = stacking(data, xint)
@@ -137,6 +151,10 @@ def downsampling(data, xint=None, tint=None, stack=True, filter=True):
             data_ds = data_ds[::tint]
         else:
             data_ds = data_ds[:, ::tint]
+
+    # only copy the (decimated) output if it is still a view of the input
+    if np.may_share_memory(data_ds, data):
+        data_ds = data_ds.copy()
     return data_ds
 
 
@@ -186,7 +204,7 @@ def padding(data, dn, reverse=False):
     if reverse:
         return data[pad[0]:nch - pad[1], pad[2]:nt - pad[3]]
     else:
-        data_pd = np.zeros((nch + dn[0], nt + dn[1]))
+        data_pd = np.zeros((nch + dn[0], nt + dn[1]), dtype=data.dtype)
         data_pd[pad[0]:nch + pad[0], pad[2]:nt + pad[2]] = data
         return data_pd
 
@@ -199,7 +217,9 @@ def time_integration(data, fs):
     :param fs: Sampling rate in Hz.
     :return: Integrated data.
     """
-    return np.cumsum(data, axis=1) / fs
+    data_int = np.cumsum(data, axis=1, dtype=np.result_type(data, 1.))
+    data_int /= fs
+    return data_int
 
 
 def time_differential(data, fs):
@@ -210,4 +230,7 @@ def time_differential(data, fs):
     :param fs: Sampling rate in Hz.
     :return: Differentiated data.
     """
-    return np.diff(data, axis=1) / fs
+    data_dif = np.subtract(data[:, 1:], data[:, :-1],
+                           dtype=np.result_type(data, 1.))
+    data_dif /= fs
+    return data_dif
@@ -36,7 +36,7 @@ setup(
         'numpy',
         'scipy>=1.13',
         'matplotlib',
-        'geographiclib',
+        'numba',
         'pyproj',
         'h5py',
         'segyio',